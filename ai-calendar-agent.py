@@ -1,15 +1,30 @@
+import asyncio
+import concurrent.futures
+import threading
 import base64
+import html
+import re
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 from typing import Optional, Literal
 from pydantic import BaseModel, Field
-from openai import OpenAI
+from openai import AsyncOpenAI
+from openai.lib._parsing._completions import type_to_response_format_param
+import httpx
 import os
 import logging
+import math
+import pickle
+import atexit
+import json
+import hashlib
+import sqlite3
+import time
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-import pytz
+from googleapiclient.errors import HttpError
 
 # Set up logging configuration
 logging.basicConfig(
@@ -19,19 +34,75 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# set up model
-OPENAI_API_KEY = "INSERT_API_KEY_HERE"
-client = OpenAI(api_key = OPENAI_API_KEY)
+# set up model; the client is created on first use so importing this module stays cheap
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        # keep connections alive between calls; http2 multiplexes concurrent requests over one connection.
+        # the api key is read from OPENAI_API_KEY by the client itself
+        _client = AsyncOpenAI(
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300),
+            ),
+        )
+    return _client
+
+# one event loop for the whole process, so pooled connections in the OpenAI client stay usable between runs
+_loop = None
+
+def run_async(coro):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
+
 model = "gpt-4o"
+router_model = "gpt-4o-mini"
+embedding_model = "text-embedding-3-small"
 
 # scope of access for Google APIs
 SCOPES = ["https://www.googleapis.com/auth/calendar", "https://www.googleapis.com/auth/gmail.readonly"]
 
+# max number of calls allowed in a single Google API batch request
+GOOGLE_BATCH_LIMIT = 100
+# gmail rate limits batches above 50 calls with per-call 429s
+GMAIL_BATCH_LIMIT = 50
+# times a rate-limited message fetch is retried, with exponential backoff between attempts
+GMAIL_FETCH_RETRIES = 3
+
+# timezone events are created in (using EST for simplicity)
+EVENT_TZ = ZoneInfo("America/New_York")
+
+# calendar new events are added to
+CALENDAR_ID = '288911f72c8e08c7b39e018928dc5253bf2e8316cbb81b5d2321b9c990028ea6@group.calendar.google.com'
+
+# max number of emails processed by the LLM at the same time
+MAX_CONCURRENT_REQUESTS = 8
+
+# only request the parts of a message we actually read (headers and body data)
+MESSAGE_FIELDS = 'payload/headers,payload/mimeType,payload/parts(mimeType,body/data),payload/body/data'
+
+# bodies larger than this (~32KB once decoded) are bulk mail; skip them without decoding
+MAX_BODY_B64_CHARS = 43692
+HTML_SCRIPT_STYLE_RX = re.compile(r'<(script|style)\b.*?</\1\s*>', re.I | re.S)
+HTML_TAG_RX = re.compile(r'<[^>]+>')
+
+# credentials and built API clients are reused for the lifetime of the process
+_creds_cache = None
+_services_cache = {}
+
 def get_credentials():
     """Get credentials for Google APIs"""
-    creds = None
+    global _creds_cache
+    if _creds_cache and _creds_cache.valid:
+        return _creds_cache
+
+    creds = _creds_cache
 
-    if os.path.exists('token.json'):
+    if not creds and os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
 
     if not creds or not creds.valid:
@@ -43,16 +114,22 @@ def get_credentials():
 
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
-    
+
+    _creds_cache = creds
     return creds
 
 
-def addEventToCal(name, location, description, startTime, endTime, attendees):
-    """Add event with specified details to calendar (using EST for simplicity)"""
-    creds = get_credentials()
-    service = build('calendar', 'v3', credentials=creds)
+def get_service(name, version):
+    """Get a cached Google API client, building it on first use"""
+    key = (name, version)
+    if key not in _services_cache:
+        _services_cache[key] = build(name, version, credentials=get_credentials(), cache_discovery=False)
+    return _services_cache[key]
 
-    event = {
+
+def build_event(name, location, description, startTime, endTime, attendees):
+    """Build the calendar event body with specified details (using EST for simplicity)"""
+    return {
         'summary': name,
         'location': location,
         'description': description,
@@ -71,22 +148,35 @@ def addEventToCal(name, location, description, startTime, endTime, attendees):
         },
     }
 
-    event = service.events().insert(calendarId='288911f72c8e08c7b39e018928dc5253bf2e8316cbb81b5d2321b9c990028ea6@group.calendar.google.com', body=event).execute()
 
+def add_events_to_cal(events):
+    """Add events to the calendar, batching the inserts into as few requests as possible.
 
-# ---------------------------------------------------------------------------
-# Data models for routing and responses; to control the flow of application
-# ---------------------------------------------------------------------------
+    Returns the created event for each input event, or None where the insert failed.
+    """
+    created = [None] * len(events)
+    if not events:
+        return created
+    service = get_service('calendar', 'v3')
 
+    def handle_insert(request_id, response, exception):
+        if exception is not None:
+            logger.error(f"Failed to add event '{events[int(request_id)]['summary']}' to calendar: {exception}")
+        else:
+            logger.info(f"Added event '{response.get('summary')}' to calendar")
+            created[int(request_id)] = response
 
-class CalendarRequestType(BaseModel):
-    """Router LLM call: Determine the type of calendar request"""
+    for i in range(0, len(events), GOOGLE_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=handle_insert)
+        for j in range(i, min(i + GOOGLE_BATCH_LIMIT, len(events))):
+            batch.add(service.events().insert(calendarId=CALENDAR_ID, body=events[j]), request_id=str(j))
+        batch.execute()
+    return created
 
-    request_type: Literal["new_event", "other"] = Field(
-        description="Type of calendar request being made"
-    )
-    confidence_score: float = Field(description="Confidence score between 0 and 1")
-    description: str = Field(description="Cleaned description of the request")
+
+# ---------------------------------------------------------------------------
+# Data models for routing and responses; to control the flow of application
+# ---------------------------------------------------------------------------
 
 
 class NewEventDetails(BaseModel):
@@ -99,6 +189,23 @@ class NewEventDetails(BaseModel):
     location: Optional[str] = Field(description="Location of the event")
     description: str = Field(description="Description of the event")
 
+
+class CalendarRoute(BaseModel):
+    """Router LLM call: Determine the type of calendar request"""
+
+    request_type: Literal["new_event", "other"] = Field(
+        description="Type of calendar request being made"
+    )
+    confidence_score: float = Field(description="Confidence score between 0 and 1")
+
+
+class CalendarDecision(CalendarRoute):
+    """Router LLM call: Determine the type of calendar request and extract event details in one pass"""
+
+    event: Optional[NewEventDetails] = Field(
+        default=None, description="Event details, only filled in for new_event requests"
+    )
+
 class CalendarResponse(BaseModel):
     """Final response format"""
 
@@ -107,126 +214,571 @@ class CalendarResponse(BaseModel):
     calendar_link: Optional[str] = Field(description="Calendar link if applicable")
 
 
-# determine whether we need to add a calendar event based on the input
-def route_calendar_request(user_input: str) -> CalendarRequestType:
-    """Router LLM call to determine the type of calendar request"""
-    logger.info("Routing calendar request")
+# ---------------------------------------------------------------------------
+# Exact-match cache for LLM calls; identical prompts return the stored result
+# ---------------------------------------------------------------------------
+
+LLM_CACHE_FILE = 'llm_cache.sqlite'
+LLM_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+_llm_cache = None
+
+# serialized JSON schema and the matching api response_format per model class, computed once each
+_schema_json_cache = {}
+_response_format_params = {}
+
+
+def _get_llm_cache():
+    global _llm_cache
+    if _llm_cache is None:
+        # WAL lets reads proceed during writes and avoids an fsync on every commit.
+        # push notifications are handled on pubsub worker threads, one at a time, so the
+        # connection is shared across threads rather than tied to the one that opened it
+        _llm_cache = sqlite3.connect(LLM_CACHE_FILE, isolation_level=None, check_same_thread=False)
+        _llm_cache.execute('PRAGMA journal_mode=WAL')
+        _llm_cache.execute('PRAGMA synchronous=NORMAL')
+        _llm_cache.execute('CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB, ts INTEGER)')
+        _llm_cache.execute('DELETE FROM cache WHERE ts < ?', (int(time.time()) - LLM_CACHE_TTL_SECONDS,))
+    return _llm_cache
+
+
+@atexit.register
+def _close_llm_cache():
+    if _llm_cache is not None:
+        _llm_cache.close()
+
+
+def _schema_json(response_format) -> str:
+    if response_format not in _schema_json_cache:
+        _schema_json_cache[response_format] = json.dumps(response_format.model_json_schema(), sort_keys=True)
+    return _schema_json_cache[response_format]
+
+
+def llm_cache_key(model, messages, response_format) -> str:
+    payload = json.dumps({'model': model, 'messages': messages}, sort_keys=True) + _schema_json(response_format)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    completion = client.beta.chat.completions.parse(
+
+def llm_cache_lookup(key: str, response_format):
+    """Return the cached result for this key, or None if it hasn't been seen"""
+    row = _get_llm_cache().execute('SELECT v FROM cache WHERE k = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    logger.info("LLM cache hit")
+    return response_format.model_validate_json(row[0])
+
+
+async def cached_parse(model, messages, response_format):
+    """Structured-output LLM call that checks the exact-match cache first.
+
+    Returns None if the model refuses to answer.
+    """
+    key = llm_cache_key(model, messages, response_format)
+    cached = llm_cache_lookup(key, response_format)
+    if cached is not None:
+        return cached
+
+    if response_format not in _response_format_params:
+        _response_format_params[response_format] = type_to_response_format_param(response_format)
+    completion = await get_client().chat.completions.create(
         model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": "Determine if this text includes a request to schedule a new calendar event. "
-                    "The user may explicitly mention 'schedule', 'set up', or 'add an event', "
-                    "but they might also imply it by suggesting a time for a conversation, meeting, or discussion. "
-                    "Examples of implicit event requests include: "
-                    "'Are you free to chat at 3 PM?' or 'Let's catch up on Monday afternoon'. "
-                    "Consider context when deciding if this is an event request.",
-            },
-            {"role": "user", "content": user_input},
-        ],
-        response_format=CalendarRequestType,
+        messages=messages,
+        response_format=_response_format_params[response_format],
     )
-    result = completion.choices[0].message.parsed
-    logger.info(
-        f"Request routed as: {result.request_type} with confidence: {result.confidence_score}"
+    message = completion.choices[0].message
+    if message.refusal or message.content is None:
+        logger.warning(f"Model refused the request: {message.refusal}")
+        return None
+
+    # the api already enforced the schema, so validate the raw json once and cache it as-is
+    content = message.content
+    result = response_format.model_validate_json(content)
+    _get_llm_cache().execute(
+        'INSERT OR REPLACE INTO cache(k, v, ts) VALUES (?, ?, ?)',
+        (key, content, int(time.time())),
     )
     return result
 
 
-def handle_new_event(description: str, sender: str) -> CalendarResponse:
-    """Process a new event request"""
-    logger.info("Processing new event request")
+# ---------------------------------------------------------------------------
+# Semantic cache for routing results; skips the LLM on near-duplicate emails
+# ---------------------------------------------------------------------------
 
-    today = datetime.now()
+SEMANTIC_CACHE_FILE = 'semantic_cache.pkl'
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# bound the cache so each lookup's linear scan stays cheap; oldest entries are dropped first
+SEMANTIC_CACHE_MAX_ENTRIES = 500
+SEMANTIC_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# list of (normalized embedding, routing result as json, timestamp), oldest first, loaded on first use
+_semantic_cache = None
+
+
+def _get_semantic_cache():
+    global _semantic_cache
+    if _semantic_cache is None:
+        _semantic_cache = []
+        if os.path.exists(SEMANTIC_CACHE_FILE):
+            with open(SEMANTIC_CACHE_FILE, 'rb') as f:
+                _semantic_cache = pickle.load(f)
+        cutoff = time.time() - SEMANTIC_CACHE_TTL_SECONDS
+        _semantic_cache = [entry for entry in _semantic_cache if entry[2] >= cutoff]
+        del _semantic_cache[:-SEMANTIC_CACHE_MAX_ENTRIES]
+    return _semantic_cache
+
+
+@atexit.register
+def save_semantic_cache():
+    if _semantic_cache:
+        # write then rename, so a process killed mid-save doesn't corrupt the cache
+        with open(SEMANTIC_CACHE_FILE + '.tmp', 'wb') as f:
+            pickle.dump(_semantic_cache, f)
+        os.replace(SEMANTIC_CACHE_FILE + '.tmp', SEMANTIC_CACHE_FILE)
+
+
+async def embed_text(text: str) -> list[float]:
+    """Embed text and normalize it so a dot product gives cosine similarity"""
+    emb = (await get_client().embeddings.create(model=embedding_model, input=text)).data[0].embedding
+    norm = math.sqrt(sum(x * x for x in emb)) or 1.0
+    return [x / norm for x in emb]
+
+
+def semantic_cache_lookup(emb: list[float]) -> Optional[CalendarDecision]:
+    """Return the cached routing result of the most similar input, if similar enough"""
+    best_score, best_result = 0.0, None
+    # iterate over a snapshot; entries may be added while this runs in a worker thread
+    for cached_emb, cached_result, _ in list(_get_semantic_cache()):
+        score = sum(a * b for a, b in zip(emb, cached_emb))
+        if score > best_score:
+            best_score, best_result = score, cached_result
+
+    if best_score >= SEMANTIC_CACHE_THRESHOLD:
+        logger.info(f"Semantic cache hit with similarity: {best_score:.3f}")
+        return CalendarDecision.model_validate_json(best_result)
+    return None
+
+
+def semantic_cache_add(emb: list[float], result: CalendarDecision):
+    # only "other" verdicts are safe to reuse; an event's details are specific to its email
+    if result.request_type == "other":
+        cache = _get_semantic_cache()
+        cache.append((emb, result.model_dump_json(), time.time()))
+        del cache[:-SEMANTIC_CACHE_MAX_ENTRIES]
+
+
+# router confidence band in which the cheaper model's verdict is re-checked by the larger one
+ESCALATION_MIN_CONFIDENCE = 0.5
+ESCALATION_MAX_CONFIDENCE = 0.85
+
+ROUTER_PROMPT = (
+    "Determine if this text includes a request to schedule a new calendar event. "
+    "The user may explicitly mention 'schedule', 'set up', or 'add an event', "
+    "but they might also imply it by suggesting a time for a conversation, meeting, or discussion. "
+    "Examples of implicit event requests include: "
+    "'Are you free to chat at 3 PM?' or 'Let's catch up on Monday afternoon'. "
+    "Consider context when deciding if this is an event request. "
+    "If it is and the response has an `event` field, fill it in with the details for creating the calendar event. "
+    "When dates reference 'next Tuesday' or similar relative dates, use the current date as reference."
+)
+
+
+def build_router_system(today: datetime) -> list[dict]:
+    """Build the router's system message; only the date changes between runs"""
     date_context = f"Today is {today.strftime('%A, %B %d, %Y')}."
+    return [{"role": "system", "content": f"{date_context} {ROUTER_PROMPT}"}]
 
-    # Get event details
-    completion = client.beta.chat.completions.parse(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": f"{date_context} Extract details for creating a new calendar event. When dates reference 'next Tuesday' or similar relative dates, use this current date as reference.",
-            },
-            {"role": "user", "content": description},
-        ],
-        response_format=NewEventDetails,
+
+# determine whether we need to add a calendar event based on the input
+async def route_calendar_request(user_input: str, router_system: list[dict]) -> Optional[CalendarDecision]:
+    """Router LLM call to determine the type of calendar request and extract any event details"""
+    logger.info("Routing calendar request")
+
+    messages = router_system + [{"role": "user", "content": user_input}]
+
+    # the cheaper model only classifies; exact hits skip the embedding call too
+    route = llm_cache_lookup(llm_cache_key(router_model, messages, CalendarRoute), CalendarRoute)
+    emb = None
+    if route is None:
+        emb = await embed_text(user_input)
+        # the scan is pure python, so keep it off the event loop
+        cached = await asyncio.to_thread(semantic_cache_lookup, emb)
+        if cached is not None:
+            return cached
+        route = await cached_parse(router_model, messages, CalendarRoute)
+        if route is None:
+            return None
+
+    # escalate uncertain verdicts, and event extraction where field accuracy matters, to the larger model
+    uncertain = ESCALATION_MIN_CONFIDENCE <= route.confidence_score < ESCALATION_MAX_CONFIDENCE
+    if uncertain or route.request_type == "new_event":
+        logger.info(f"Escalating request to {model}")
+        result = await cached_parse(model, messages, CalendarDecision)
+        if result is None:
+            return None
+    else:
+        result = CalendarDecision(request_type=route.request_type, confidence_score=route.confidence_score)
+
+    logger.info(
+        f"Request routed as: {result.request_type} with confidence: {result.confidence_score}"
     )
-    details = completion.choices[0].message.parsed
+    if emb is not None:
+        semantic_cache_add(emb, result)
+    return result
+
+
+# how far ahead an extracted event may be before it's treated as a bad extraction
+MAX_EVENT_DAYS_AHEAD = 365
+
+async def handle_new_event(details: NewEventDetails, sender: str, today: datetime) -> tuple[CalendarResponse, Optional[dict]]:
+    """Process a new event request, returning the response and the event body to insert"""
+    logger.info("Processing new event request")
 
     logger.info(f"New event: {details.model_dump_json(indent=2)}")
 
-    event_timezone = pytz.timezone("America/New_York") # for simplicity
-    dt_obj = datetime.fromisoformat(details.date).astimezone(event_timezone)
+    try:
+        dt_obj = datetime.fromisoformat(details.date)
+    except ValueError:
+        dt_obj = None
+    if dt_obj is not None:
+        # the prompt's date is in EVENT_TZ, so a time without an offset means EVENT_TZ, not the server's zone
+        dt_obj = dt_obj.replace(tzinfo=EVENT_TZ) if dt_obj.tzinfo is None else dt_obj.astimezone(EVENT_TZ)
+
+    # don't add unparseable, past, or implausibly distant events to the calendar
+    if dt_obj is None or dt_obj < today or dt_obj > today + timedelta(days=MAX_EVENT_DAYS_AHEAD):
+        logger.warning(f"Invalid date extracted: {details.date}")
+        return CalendarResponse(success=False, message="Invalid date extracted", calendar_link=None), None
 
     endtime = None
     if details.duration_minutes is None:
         endtime = dt_obj + timedelta(minutes=60)
     else:
         endtime = dt_obj + timedelta(minutes=details.duration_minutes)
-    
-    # actually add event to calendar
-    addEventToCal(details.name, details.location or "", details.description, dt_obj.isoformat(), endtime.isoformat(), [{'email': sender}])
-
-    return CalendarResponse(
-        success=True,
-        message=f"Created new event '{details.name}' for {details.date} with {sender}",
-        calendar_link=f"calendar://new?event={details.name}",
+
+    # the event is added to the calendar later, batched with the rest of this run's events
+    event = build_event(details.name, details.location or "", details.description, dt_obj.isoformat(), endtime.isoformat(), [{'email': sender}])
+
+    # success is only reported once the event has actually been inserted
+    response = CalendarResponse(
+        success=False,
+        message=f"Event '{details.name}' for {details.date} with {sender} is waiting to be added",
+        calendar_link=None,
     )
+    return response, event
+
+# cheap check for any scheduling signal before paying for the router LLM call.
+# a miss here silently drops a real invite, so keep it broad; false positives only cost a router call
+SCHED_RX = re.compile(
+    r'\b(meet|meeting|schedule|call|chat|catch up|sync|available|free|appointment'
+    r'|coffee|lunch|dinner|breakfast|drinks|noon|midnight'
+    r'|today|tonight|tomorrow|next week|this week|weekend'
+    r'|\d{1,2}(?::\d{2})?\s?(?:am|pm)|\d{1,2}:\d{2}'
+    r'|monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b',
+    re.I,
+)
+MAX_INPUT_LENGTH = 20000
 
-def process_calendar_request(user_input: str, sender: str) -> Optional[CalendarResponse]:
+async def process_calendar_request_async(user_input: str, sender: str, router_system: list[dict], today: datetime) -> Optional[tuple[CalendarResponse, Optional[dict]]]:
     """Main function implementing the routing workflow"""
     logger.info("Processing calendar request")
 
-    route_result = route_calendar_request(user_input)
+    if len(user_input) >= MAX_INPUT_LENGTH or not SCHED_RX.search(user_input):
+        logger.info("No scheduling signal found, skipping")
+        return None
+
+    route_result = await route_calendar_request(user_input, router_system)
+
+    if route_result is None:
+        logger.warning("Request could not be routed")
+        return None
 
     if route_result.confidence_score < 0.7:
         logger.warning(f"Low confidence score: {route_result.confidence_score}")
         return None
 
     if route_result.request_type == "new_event":
-        return handle_new_event(route_result.description, sender)
+        if route_result.event is None:
+            logger.warning("Event request without event details")
+            return None
+        return await handle_new_event(route_result.event, sender, today)
     else:
         logger.warning("Request type not supported")
         return None
 
+def process_calendar_request(user_input: str, sender: str) -> Optional[CalendarResponse]:
+    """Synchronous entry point for processing a single request"""
+    today = datetime.now(EVENT_TZ)
+    result = run_async(process_calendar_request_async(user_input, sender, build_router_system(today), today))
+    if result is None:
+        return None
+    add_responses_to_cal([result])
+    return result[0]
+
+def add_responses_to_cal(results: list[Optional[tuple[CalendarResponse, Optional[dict]]]]) -> list[bool]:
+    """Insert the pending events of these results and update each response with the outcome.
+
+    Returns, for each result, False if its event failed to insert and True otherwise.
+    """
+    inserted = [True] * len(results)
+    pending = [i for i, r in enumerate(results) if r and r[1]]
+    for i, created in zip(pending, add_events_to_cal([results[i][1] for i in pending])):
+        response, event = results[i]
+        if created is None:
+            inserted[i] = False
+            response.message = f"Failed to add event '{event['summary']}' to calendar"
+        else:
+            response.success = True
+            response.message = f"Created new event '{event['summary']}' for {event['start']['dateTime']} with {event['attendees'][0]['email']}"
+            response.calendar_link = created.get('htmlLink')
+    return inserted
+
+async def process_calendar_requests(requests: list[tuple[str, str]], router_system: list[dict], today: datetime) -> list:
+    """Process (body, sender) pairs concurrently, capped at MAX_CONCURRENT_REQUESTS.
+
+    A request that raised has its exception in place of a result, so one failure doesn't stop the rest.
+    """
+    # create the client up front so a missing api key fails the run once, not once per message
+    get_client()
+    # load the semantic cache before lookups start running in worker threads
+    _get_semantic_cache()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def process_one(user_input, sender):
+        async with sem:
+            try:
+                return await process_calendar_request_async(user_input, sender, router_system, today)
+            except Exception as e:
+                logger.error(f"Failed to process message from {sender}: {e}")
+                raise
+
+    return await asyncio.gather(
+        *(process_one(user_input, sender) for user_input, sender in requests), return_exceptions=True)
+
+def process_message_ids(message_ids):
+    """Fetch the given messages, route them, and add any events to the calendar.
+
+    Returns the ids of messages that failed along the way and should be retried.
+    """
+    service = get_service('gmail', 'v1')
+    fetched_ids = []
+    requests = []
+    failed = []
+    rate_limited = []
+
+    def handle_message(request_id, response, exception):
+        if isinstance(exception, HttpError) and exception.resp.status == 429:
+            rate_limited.append(request_id)
+            return
+        if exception is not None:
+            logger.error(f"Failed to fetch message {request_id}: {exception}")
+            # a deleted message will never be fetchable, so don't retry it
+            if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                failed.append(request_id)
+            return
+        headers = _extract_headers(response)
+        fetched_ids.append(request_id)
+        requests.append((get_message_body(response), get_sender(headers)))
+
+    # fetch messages in batches instead of one round trip per message
+    pending = list(message_ids)
+    for attempt in range(GMAIL_FETCH_RETRIES + 1):
+        if attempt:
+            logger.warning(f"Rate limited fetching {len(pending)} messages, retrying")
+            time.sleep(2 ** attempt)
+        for i in range(0, len(pending), GMAIL_BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=handle_message)
+            for message_id in pending[i:i + GMAIL_BATCH_LIMIT]:
+                batch.add(service.users().messages().get(userId='me', id=message_id, fields=MESSAGE_FIELDS), request_id=message_id)
+            batch.execute()
+        if not rate_limited:
+            break
+        pending, rate_limited = rate_limited, []
+    for message_id in rate_limited:
+        logger.error(f"Failed to fetch message {message_id}: still rate limited after {GMAIL_FETCH_RETRIES} retries")
+    failed.extend(rate_limited)
+
+    # messages are independent, so route them all concurrently
+    today = datetime.now(EVENT_TZ)
+    results = run_async(process_calendar_requests(requests, build_router_system(today), today))
+    failed.extend(message_id for message_id, result in zip(fetched_ids, results) if isinstance(result, Exception))
+    results = [None if isinstance(result, Exception) else result for result in results]
+    inserted = add_responses_to_cal(results)
+    failed.extend(message_id for message_id, ok in zip(fetched_ids, inserted) if not ok)
+    return failed
+
+# gmail history id up to which the inbox has been processed, kept between runs
+HISTORY_ID_FILE = 'history_id.txt'
+
+def load_history_id():
+    if os.path.exists(HISTORY_ID_FILE):
+        with open(HISTORY_ID_FILE) as f:
+            return f.read().strip() or None
+    return None
+
+def save_history_id(history_id):
+    with open(HISTORY_ID_FILE, 'w') as f:
+        f.write(str(history_id))
+
+# messages that failed to process, with how many attempts they've had, retried on the next sync
+FAILED_MESSAGES_FILE = 'failed_messages.json'
+MAX_MESSAGE_ATTEMPTS = 5
+
+def load_failed_messages():
+    if os.path.exists(FAILED_MESSAGES_FILE):
+        with open(FAILED_MESSAGES_FILE) as f:
+            return json.load(f)
+    return {}
+
+def save_failed_messages(failed):
+    with open(FAILED_MESSAGES_FILE, 'w') as f:
+        json.dump(failed, f)
+
+def sync_inbox(history_id):
+    """Process mail added since history_id, doing a full sync if there's no usable id.
+
+    Messages that fail are saved and retried on the next sync, so moving the history id
+    forward never loses them. Saves and returns the history id the inbox has now been processed up to.
+    """
+    message_ids = None
+    if history_id is not None:
+        try:
+            message_ids, history_id = new_message_ids_since(history_id)
+        except HttpError as e:
+            # gmail only keeps about a week of history; fall back to a full sync
+            if e.resp.status != 404:
+                raise
+            logger.warning("Stored history id has expired, doing a full sync")
+
+    if message_ids is None:
+        service = get_service('gmail', 'v1')
+        history_id = service.users().getProfile(userId='me').execute()['historyId']
+        # Get list of unread messages
+        results = service.users().messages().list(
+            userId='me', labelIds=['INBOX', 'UNREAD'], q='is:unread newer_than:1d', maxResults=10).execute()
+        message_ids = [m['id'] for m in results.get('messages', [])]
+
+    attempts = load_failed_messages()
+    failed = process_message_ids(list(dict.fromkeys(list(attempts) + message_ids)))
+
+    retry = {}
+    for message_id in failed:
+        retry[message_id] = attempts.get(message_id, 0) + 1
+        if retry[message_id] >= MAX_MESSAGE_ATTEMPTS:
+            logger.error(f"Giving up on message {message_id} after {retry[message_id]} attempts")
+            del retry[message_id]
+    # record failures before moving the history id past them
+    save_failed_messages(retry)
+    save_history_id(history_id)
+    return history_id
+
 def process_new_messages():
-    creds = get_credentials()
-    service = build('gmail', 'v1', credentials=creds)
-    # Get list of unread messages
-    results = service.users().messages().list(
-        userId='me', labelIds=['INBOX', 'UNREAD'], maxResults=10).execute()
-    messages = results.get('messages', [])
-    
-    for message in messages:
-        msg = service.users().messages().get(userId='me', id=message['id']).execute()
-        # Process message data here
-        process_calendar_request(get_message_body(msg), get_sender(msg))
-        
+    sync_inbox(load_history_id())
+
+def new_message_ids_since(history_id):
+    """Get the ids of messages added to the inbox after history_id, and the latest history id"""
+    service = get_service('gmail', 'v1')
+    # dict keeps first-seen order while deduplicating ids
+    message_ids = {}
+    request = service.users().history().list(
+        userId='me', startHistoryId=history_id, historyTypes=['messageAdded'], labelId='INBOX')
+    while request is not None:
+        response = request.execute()
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_ids[added['message']['id']] = None
+        history_id = response.get('historyId', history_id)
+        request = service.users().history().list_next(request, response)
+
+    return list(message_ids), history_id
+
+# ---------------------------------------------------------------------------
+# Gmail push notifications; only spend API calls when mail actually arrives
+# ---------------------------------------------------------------------------
+
+# Pub/Sub topic Gmail publishes to and the subscription we pull from, e.g.
+# 'projects/<project>/topics/gmail-push' and 'projects/<project>/subscriptions/gmail-push-sub'
+GMAIL_PUSH_TOPIC = None
+GMAIL_PUSH_SUBSCRIPTION = None
+
+# gmail watches expire after 7 days; renew well before that
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+
+def watch_inbox():
+    """Ask Gmail to publish inbox changes to GMAIL_PUSH_TOPIC; returns the current history id"""
+    service = get_service('gmail', 'v1')
+    response = service.users().watch(
+        userId='me', body={'topicName': GMAIL_PUSH_TOPIC, 'labelIds': ['INBOX']}).execute()
+    logger.info(f"Watching inbox until {response['expiration']}")
+    return response['historyId']
+
+def listen_for_pushes():
+    """Process new mail as Gmail push notifications arrive, renewing the watch periodically"""
+    from google.cloud import pubsub_v1
+
+    subscriber = pubsub_v1.SubscriberClient()
+    lock = threading.Lock()
+    watched_history_id = watch_inbox()
+    # pick up anything that arrived while we weren't listening
+    state = {'history_id': load_history_id() or watched_history_id}
+
+    def handle_push(message):
+        # the notification only signals a change; fetch everything since the last id we processed
+        with lock:
+            try:
+                state['history_id'] = sync_inbox(state['history_id'])
+            except Exception as e:
+                logger.error(f"Failed to process push notification: {e}")
+            # the listener runs until killed, so don't rely on atexit to persist the cache
+            save_semantic_cache()
+        message.ack()
+
+    # google api clients aren't thread safe, so handle one notification at a time
+    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
+    while True:
+        future = subscriber.subscribe(GMAIL_PUSH_SUBSCRIPTION, callback=handle_push, flow_control=flow_control)
+        try:
+            future.result(timeout=WATCH_RENEW_SECONDS)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            future.result()
+            with lock:
+                watch_inbox()
+
+
+def decode_body(data, mime_type='text/plain'):
+    """Decode a base64url body to text, stripping markup from HTML"""
+    if len(data) > MAX_BODY_B64_CHARS:
+        logger.info("Message body too large, skipping")
+        return ""
+    text = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='ignore')
+    if mime_type == 'text/html':
+        text = html.unescape(HTML_TAG_RX.sub('', HTML_SCRIPT_STYLE_RX.sub('', text)))
+    return text
+
 def get_message_body(message):
-    if 'parts' in message['payload']:
-        # Multipart message
-        for part in message['payload']['parts']:
-            if part['mimeType'] == 'text/plain':
-                if 'data' in part['body']:
-                    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-    elif 'body' in message['payload'] and 'data' in message['payload']['body']:
+    payload = message['payload']
+    if 'parts' in payload:
+        # Multipart message; prefer the first plain text part, fall back to html
+        for mime_type in ('text/plain', 'text/html'):
+            for part in payload['parts']:
+                if part['mimeType'] == mime_type and 'data' in part.get('body', {}):
+                    return decode_body(part['body']['data'], mime_type)
+    elif 'body' in payload and 'data' in payload['body']:
         # Simple message
-        return base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
+        return decode_body(payload['body']['data'], payload.get('mimeType', 'text/plain'))
     return ""
 
-def get_sender(message):
-    headers = message['payload']['headers']
-    for header in headers:
-        if header['name'] == 'From':
-            return header['value']
-    return "(Unknown sender)"
+def _extract_headers(message):
+    return {h['name']: h['value'] for h in message['payload']['headers']}
+
+def get_sender(headers):
+    return headers.get('From', "(Unknown sender)")
 
 def main():
     get_credentials()
-    process_new_messages()
+    if GMAIL_PUSH_TOPIC and GMAIL_PUSH_SUBSCRIPTION:
+        listen_for_pushes()
+    else:
+        process_new_messages()
 
 if __name__ == '__main__':
     main()